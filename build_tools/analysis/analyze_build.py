@@ -29,8 +29,11 @@ def main():
 
     analyzer = BEPAnalyzer(bep_file)
 
-    # Extract and display metrics
-    metrics = analyzer.extract_metrics()
+    # Extract metrics, failures and the top 10 slow actions in a single pass
+    analysis = analyzer.analyze(args.threshold_ms, top_n=10)
+
+    # Display metrics
+    metrics = analysis.metrics
     print("=" * 60)
     print("BUILD METRICS")
     print("=" * 60)
@@ -47,7 +50,7 @@ def main():
         print(f"Cache Hit Rate:      {cache_rate:.1f}%")
 
     # Show failed targets
-    failed_targets = analyzer.get_failed_targets()
+    failed_targets = analysis.failed_targets
     if failed_targets:
         print("\n" + "=" * 60)
         print("FAILED TARGETS")
@@ -57,13 +60,13 @@ def main():
 
     # Show slow actions if requested
     if args.show_slow_actions:
-        slow_actions = analyzer.get_slow_actions(args.threshold_ms)
+        slow_actions = analysis.slow_actions
         if slow_actions:
             print("\n" + "=" * 60)
             print(f"SLOW ACTIONS (>{args.threshold_ms}ms)")
             print("=" * 60)
-            for action in slow_actions[:10]:  # Top 10
-                print(f"  {action['duration_ms']:>6}ms  {action['mnemonic']:>20}  {action['target']}")
+            for action in slow_actions:
+                print(f"  {action.duration_ms:>6}ms  {action.mnemonic:>20}  {action.target}")
 
     print("\n" + "=" * 60)
 
@@ -8,14 +8,48 @@ This module provides utilities for:
 - Identifying affected targets
 """
 
-import json
+import functools
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import pickle
+import re
 import subprocess
-from dataclasses import dataclass
+import tempfile
+import warnings
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from operator import attrgetter
 from pathlib import Path
-from typing import List, Set, Dict, Optional
+from typing import Iterable, Iterator, List, Set, Dict, Optional, Tuple, Union
 
+import orjson
 
-@dataclass
+_logger = logging.getLogger(__name__)
+
+# Separator between the two quoted labels of a DOT edge line.
+_DOT_EDGE_SEP = b'" -> "'
+
+# .bzl, MODULE.bazel and WORKSPACE changes are not mapped to targets: which
+# packages load a .bzl file is only answerable by an rbuildfiles() Sky Query,
+# and the module files affect the whole build, so they select nothing here.
+_BUILD_FILE_NAMES = ("BUILD.bazel", "BUILD")
+# Untracked files Bazel itself creates at the workspace root: the module lock
+# file and the bazel-* convenience symlinks. Neither is a query input.
+_BAZEL_GENERATED_RE = re.compile(r'MODULE\.bazel\.lock$|bazel-[^/]+$')
+
+_CACHE_DIR = Path.home() / ".cache" / "bazel_utils"
+_RGRAPH_CACHE_FILE = _CACHE_DIR / "rgraph.pickle"
+_QUERY_CACHE_DIR = _CACHE_DIR / "query"
+_QUERY_CACHE_MAX_ENTRIES = 512
+
+# Reverse dependency graphs of //..., keyed by workspace state.
+_reverse_graph_cache: Dict[str, Dict[str, List[str]]] = {}
+
+
+@dataclass(slots=True, frozen=True)
 class BuildMetrics:
     """Metrics extracted from a Bazel build."""
     total_targets: int
@@ -27,7 +61,23 @@ class BuildMetrics:
     remote_cache_hits: int
 
 
-@dataclass
+@dataclass(slots=True)
+class SlowAction:
+    """An action whose execution time exceeded the slow-action threshold."""
+    mnemonic: str
+    duration_ms: Union[int, float]
+    target: str
+
+
+@dataclass(slots=True)
+class BEPAnalysis:
+    """Results of a single pass over a BEP file."""
+    metrics: BuildMetrics
+    failed_targets: List[str] = field(default_factory=list)
+    slow_actions: List[SlowAction] = field(default_factory=list)
+
+
+@dataclass(slots=True, frozen=True)
 class Target:
     """Represents a Bazel target."""
     label: str
@@ -35,19 +85,293 @@ class Target:
     size: Optional[str] = None
 
 
-class BazelQuery:
-    """Execute Bazel queries and parse results."""
+def _workspace_root() -> str:
+    """Return the workspace root that paths, git and bazel calls resolve against.
 
-    @staticmethod
-    def query(expression: str) -> List[str]:
-        """Execute a Bazel query and return target labels."""
-        result = subprocess.run(
-            ["bazel", "query", expression, "--output=label"],
+    Under `bazel run` the process starts in the runfiles tree, so the
+    workspace is taken from BUILD_WORKSPACE_DIRECTORY when it is set.
+    """
+    return os.environ.get("BUILD_WORKSPACE_DIRECTORY") or os.getcwd()
+
+
+def _workspace_key() -> Optional[str]:
+    """Identify the committed workspace state.
+
+    Returns None when tracked files have uncommitted changes, or when an
+    untracked file could change query results (see _affects_query), since
+    BUILD files and glob results may then differ from what HEAD describes.
+    """
+    root = _workspace_root()
+    try:
+        head = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
             capture_output=True,
             text=True,
             check=True,
-        )
-        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+            cwd=root,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=root,
+        ).stdout
+        untracked = subprocess.run(
+            ["git", "ls-files", "--others", "--exclude-standard", "-z"],
+            capture_output=True,
+            check=True,
+            cwd=root,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if status.strip():
+        return None
+    for path in untracked.split(b'\x00'):
+        if path and _affects_query(root, path.decode('utf-8', 'surrogateescape')):
+            return None
+    return f"{root}@{head}"
+
+
+def _affects_query(root: str, path: str) -> bool:
+    """Tell whether an untracked file could change bazel query results.
+
+    A new BUILD file adds a package, and a file inside a package can be
+    picked up by glob(). Files Bazel generates at the root are not inputs.
+    """
+    if os.path.basename(path) in _BUILD_FILE_NAMES:
+        return True
+    if _BAZEL_GENERATED_RE.match(path):
+        return False
+    return _find_package(root, os.path.dirname(path)) is not None
+
+
+def _workspace_fingerprint() -> Optional[str]:
+    """Fingerprint the workspace state that query results depend on.
+
+    Combines the WORKSPACE and MODULE.bazel modification times with the
+    committed state from _workspace_key(). Returns None for trees with
+    uncommitted changes or untracked query inputs, whose BUILD files may
+    not match any cached result.
+    """
+    key = _workspace_key()
+    if key is None:
+        return None
+    root = _workspace_root()
+    mtimes = []
+    for name in ("WORKSPACE", "MODULE.bazel"):
+        try:
+            mtimes.append(str(os.stat(os.path.join(root, name)).st_mtime_ns))
+        except OSError:
+            mtimes.append("")
+    return "|".join([key, *mtimes])
+
+
+def _load_pickle(path: Path):
+    """Load a pickled cache entry, returning None if it is missing or unreadable."""
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def _save_pickle(path: Path, value):
+    """Write a cache entry; caching is best-effort so failures are ignored.
+
+    The entry is written to a temporary file and renamed into place, so
+    concurrent readers never see a partially written pickle.
+    """
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
+def _prune_cache_dir(directory: Path, max_entries: int):
+    """Delete the least recently used entries beyond `max_entries`."""
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith('.pickle')]
+        if len(entries) <= max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in entries[:len(entries) - max_entries]:
+            os.unlink(entry.path)
+    except OSError:
+        pass
+
+
+def _cached_query(func):
+    """Memoise a query function in-process and on disk.
+
+    The wrapped function returns (labels, complete); only complete results
+    are written to disk, and the wrapper returns just the labels.
+
+    Results are reused across invocations for as long as the workspace
+    fingerprint is unchanged. The disk layer keeps at most
+    _QUERY_CACHE_MAX_ENTRIES results, evicting the least recently used.
+    Callers get a fresh list on every call.
+    """
+    @functools.lru_cache(maxsize=1024)
+    def cached(expression: str, keep_going: bool) -> tuple:
+        fingerprint = _workspace_fingerprint()
+        path = None
+        if fingerprint is not None:
+            digest = hashlib.blake2b(
+                f"{func.__name__}\0{expression}\0{keep_going}\0{fingerprint}".encode()
+            ).hexdigest()
+            path = _QUERY_CACHE_DIR / f"{digest}.pickle"
+            labels = _load_pickle(path)
+            if labels is not None:
+                # Refresh the mtime so pruning evicts least recently used entries.
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return labels
+
+        labels, complete = func(expression, keep_going=keep_going)
+        labels = tuple(labels)
+        # Partial --keep_going results may stem from transient failures, so
+        # they are only reused within this process.
+        if path is not None and complete:
+            _save_pickle(path, labels)
+            _prune_cache_dir(_QUERY_CACHE_DIR, _QUERY_CACHE_MAX_ENTRIES)
+        return labels
+
+    @functools.wraps(func)
+    def wrapper(expression: str, keep_going: bool = False) -> List[str]:
+        return list(cached(expression, keep_going))
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def _find_package(root: str, directory: str) -> Optional[str]:
+    """Return the nearest directory at or above `directory` with a BUILD file.
+
+    `directory` is relative to the workspace `root`, which is returned as "".
+    Returns None when no enclosing package exists.
+    """
+    if any(os.path.isfile(os.path.join(root, directory, name)) for name in _BUILD_FILE_NAMES):
+        return directory
+    parent = os.path.dirname(directory)
+    if parent == directory:
+        return None
+    return _find_package(root, parent)
+
+
+def _run_query(args: List[str], keep_going: bool = False) -> Tuple[bytes, bool]:
+    """Run a bazel query command and return its raw stdout and completeness.
+
+    With keep_going, --keep_going is passed and exit code 3 (partial result)
+    is accepted alongside 0; the second element is then False and Bazel's
+    stderr is logged. Any other failure raises CalledProcessError.
+    """
+    if keep_going:
+        args = [*args, "--keep_going"]
+    result = subprocess.run(args, capture_output=True, cwd=_workspace_root())
+    if result.returncode not in ((0, 3) if keep_going else (0,)):
+        raise subprocess.CalledProcessError(
+            result.returncode, result.args, result.stdout, result.stderr)
+    complete = result.returncode == 0
+    if not complete:
+        _logger.warning("bazel query returned a partial result:\n%s",
+                        result.stderr.decode(errors='replace').strip())
+    return result.stdout, complete
+
+
+def _parse_labels(output: bytes) -> List[str]:
+    """Split `--output=label` query output into labels, decoding each line once."""
+    return [line.strip().decode() for line in output.splitlines() if line.strip()]
+
+
+def _parse_dot_graph(dot: bytes) -> Dict[str, List[str]]:
+    """Parse DOT output from `bazel query --output=graph` into an adjacency map.
+
+    Lines are scanned with bytes.find rather than a regex; the output is
+    regular enough that locating the quotes is all the parsing needed.
+    """
+    graph: Dict[str, List[str]] = {}
+    for line in dot.splitlines():
+        line = line.strip()
+        if not line.startswith(b'"'):
+            # digraph header, node defaults and the closing brace
+            continue
+        sep = line.find(_DOT_EDGE_SEP)
+        if sep == -1:
+            graph.setdefault(line[1:line.find(b'"', 1)].decode(), [])
+            continue
+        dst_start = sep + len(_DOT_EDGE_SEP)
+        src = line[1:sep].decode()
+        dst = line[dst_start:line.find(b'"', dst_start)].decode()
+        graph.setdefault(src, []).append(dst)
+        graph.setdefault(dst, [])
+    return graph
+
+
+@_cached_query
+def _query(expression: str, keep_going: bool = False) -> Tuple[List[str], bool]:
+    """Run a label query; the flag is False for a partial --keep_going result."""
+    output, complete = _run_query(
+        ["bazel", "query", expression, "--output=label"], keep_going)
+    return _parse_labels(output), complete
+
+
+@_cached_query
+def _query_file(expression: str, keep_going: bool = False) -> Tuple[List[str], bool]:
+    """Run a label query read from a file; see _query for the flag."""
+    with tempfile.NamedTemporaryFile('w', suffix='.query') as query_file:
+        query_file.write(expression)
+        query_file.flush()
+        output, complete = _run_query(
+            ["bazel", "query", f"--query_file={query_file.name}", "--output=label"],
+            keep_going)
+    return _parse_labels(output), complete
+
+
+def _query_graph(target: str, keep_going: bool = False) -> Tuple[Dict[str, List[str]], bool]:
+    """Run a deps() graph query; the flag is False for a partial --keep_going graph."""
+    # --graph:node_limit=-1 stops long labels from being truncated, which
+    # would otherwise break the quoted-label scan in _parse_dot_graph.
+    output, complete = _run_query(
+        ["bazel", "query", f"deps({target})", "--output=graph",
+         "--nograph:factored", "--graph:node_limit=-1"],
+        keep_going)
+    return _parse_dot_graph(output), complete
+
+
+class BazelQuery:
+    """Execute Bazel queries and parse results."""
+
+    @staticmethod
+    def query(expression: str, keep_going: bool = False) -> List[str]:
+        """Execute a Bazel query and return target labels.
+
+        With keep_going, targets Bazel could resolve are returned even if
+        parts of the expression failed.
+        """
+        return _query(expression, keep_going)
+
+    @staticmethod
+    def query_file(expression: str, keep_going: bool = False) -> List[str]:
+        """Execute a Bazel query read from a file.
+
+        Passing the expression via --query_file avoids command-line length
+        limits for large target sets.
+        """
+        return _query_file(expression, keep_going)
 
     @staticmethod
     def cquery(expression: str) -> List[str]:
@@ -55,10 +379,10 @@ class BazelQuery:
         result = subprocess.run(
             ["bazel", "cquery", expression, "--output=label"],
             capture_output=True,
-            text=True,
             check=True,
+            cwd=_workspace_root(),
         )
-        return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+        return _parse_labels(result.stdout)
 
     @staticmethod
     def rdeps(universe: str, target: str, depth: int = 1) -> List[str]:
@@ -72,6 +396,13 @@ class BazelQuery:
         query = f'deps({target}, {depth})'
         return BazelQuery.query(query)
 
+    @staticmethod
+    def deps_graph(target: str) -> Dict[str, List[str]]:
+        """Return the transitive dependency graph of a target as an adjacency map."""
+        # Without --keep_going any failure raises, so the graph is complete.
+        graph, _ = _query_graph(target)
+        return graph
+
     @staticmethod
     def kind(kind: str, pattern: str = "//...") -> List[str]:
         """Find all targets of a specific kind."""
@@ -79,145 +410,369 @@ class BazelQuery:
         return BazelQuery.query(query)
 
 
+# Positions of the BuildMetrics fields in the accumulator used by BEPAnalyzer.
+(_TOTAL_TARGETS, _SUCCESSFUL, _FAILED, _TOTAL_TIME,
+ _ACTION_COUNT, _CACHE_HITS, _REMOTE_CACHE_HITS) = range(7)
+_METRIC_COUNT = 7
+
+
+def _h_configured(payload: Dict, acc: List[int]):
+    """Count a configured target."""
+    acc[_TOTAL_TARGETS] += 1
+
+
+def _h_completed(payload: Dict, acc: List[int]):
+    """Count a completed target as successful or failed."""
+    if payload.get('success'):
+        acc[_SUCCESSFUL] += 1
+    else:
+        acc[_FAILED] += 1
+
+
+def _h_action(payload: Dict, acc: List[int]):
+    """Count an executed action and whether it hit the local or remote cache."""
+    acc[_ACTION_COUNT] += 1
+    if payload.get('type') == 'CACHE_HIT':
+        acc[_CACHE_HITS] += 1
+    if payload.get('primaryOutput', {}).get('uri', '').startswith('remote://'):
+        acc[_REMOTE_CACHE_HITS] += 1
+
+
+def _h_finished(payload: Dict, acc: List[int]):
+    """Record the wall-clock duration of the build."""
+    if 'finishTimeMillis' in payload and 'startTimeMillis' in payload:
+        acc[_TOTAL_TIME] = payload['finishTimeMillis'] - payload.get('startTimeMillis', 0)
+
+
+# BEP event payload key -> metric handler, so each event only pays for the
+# keys it actually carries.
+_METRIC_HANDLERS = {
+    'configured': _h_configured,
+    'completed': _h_completed,
+    'action': _h_action,
+    'finished': _h_finished,
+}
+
+
+def _warn_single_result(method: str, attribute: str):
+    """Warn that a single-result BEPAnalyzer method re-reads the whole file."""
+    warnings.warn(
+        f"BEPAnalyzer.{method}() reads the whole BEP file for one result; "
+        f"use BEPAnalyzer.analyze().{attribute} instead",
+        DeprecationWarning,
+        stacklevel=3,
+    )
+
+
+def _as_number(value) -> Optional[Union[int, float]]:
+    """Return a BEP numeric field as a number, or None if it is not one.
+
+    proto3 JSON encodes int64 fields such as executionTimeInMs as strings.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Matches raw BEP lines carrying a payload analyze() looks at. Progress,
+# file-set and other events -- usually the bulk of the file -- never reach
+# the JSON decoder.
+_ANALYZED_EVENT_RE = re.compile(
+    rb'"(?:' + b'|'.join(re.escape(key.encode()) for key in (*_METRIC_HANDLERS, 'aborted')) + rb')"')
+
+
 class BEPAnalyzer:
-    """Analyze Build Event Protocol JSON files."""
+    """Analyze Build Event Protocol JSON files.
+
+    Events are streamed from disk rather than held in memory, so analysis
+    cost stays flat in the size of the BEP file.
+    """
 
     def __init__(self, bep_file: Path):
         self.bep_file = bep_file
-        self.events = []
-        self._load_events()
 
-    def _load_events(self):
-        """Load and parse BEP JSON file."""
-        with open(self.bep_file, 'r') as f:
-            for line in f:
-                if line.strip():
-                    self.events.append(json.loads(line))
+    def _iter_events(self, pattern: Optional[re.Pattern] = None) -> Iterator[Dict]:
+        """Yield parsed BEP events one line at a time.
+
+        The file is memory-mapped and line ends are located with find(), so
+        events are decoded straight from the mapping without buffered reads.
+        When `pattern` is given, lines it does not match are skipped without
+        being parsed.
+        """
+        with open(self.bep_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap cannot map an empty file
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                find = mm.find
+                loads = orjson.loads
+                search = pattern.search if pattern is not None else None
+                start = 0
+                end = len(mm)
+                while start < end:
+                    newline = find(b'\n', start)
+                    if newline == -1:
+                        newline = end
+                    line = mm[start:newline]
+                    start = newline + 1
+                    if search is not None and search(line) is None:
+                        continue
+                    if line.strip():
+                        yield loads(line)
+
+    def analyze(self, threshold_ms: int = 1000, top_n: Optional[int] = None) -> BEPAnalysis:
+        """Extract metrics, failed targets and slow actions in one pass.
+
+        Slow actions are sorted slowest first. With top_n, only the top_n
+        slowest are kept, in a bounded heap filled while streaming. Numeric
+        strings are accepted as durations; other values are ignored rather
+        than failing the analysis.
+        """
+        acc = [0] * _METRIC_COUNT
+        failed_targets = []
+        slow_actions: List[SlowAction] = []
+        # Heap entries are (duration, -arrival, action): the heap root is the
+        # fastest kept action, and ties keep the earlier action like a stable
+        # sort.
+        slow_heap = []
+        slow_seen = 0
+        # Bound once; these run for every event.
+        get_handler = _METRIC_HANDLERS.get
+        add_failed = failed_targets.append
+        add_slow = slow_actions.append
+
+        for event in self._iter_events(_ANALYZED_EVENT_RE):
+            for key in event:
+                handler = get_handler(key)
+                if handler is not None:
+                    handler(event[key], acc)
 
-    def extract_metrics(self) -> BuildMetrics:
-        """Extract build metrics from BEP events."""
-        total_targets = 0
-        successful = 0
-        failed = 0
-        total_time = 0
-        action_count = 0
-        cache_hits = 0
-        remote_cache_hits = 0
-
-        for event in self.events:
-            if 'configured' in event:
-                total_targets += 1
-
-            if 'completed' in event:
-                completed = event['completed']
-                if completed.get('success'):
-                    successful += 1
-                else:
-                    failed += 1
-
-            if 'action' in event:
-                action = event['action']
-                action_count += 1
-                if action.get('type') == 'CACHE_HIT':
-                    cache_hits += 1
-                if action.get('primaryOutput', {}).get('uri', '').startswith('remote://'):
-                    remote_cache_hits += 1
-
-            if 'finished' in event:
-                finished = event['finished']
-                if 'finishTimeMillis' in finished and 'startTimeMillis' in finished:
-                    total_time = finished['finishTimeMillis'] - finished.get('startTimeMillis', 0)
-
-        return BuildMetrics(
-            total_targets=total_targets,
-            successful_targets=successful,
-            failed_targets=failed,
-            total_time_ms=total_time,
-            action_count=action_count,
-            cache_hits=cache_hits,
-            remote_cache_hits=remote_cache_hits,
-        )
-
-    def get_failed_targets(self) -> List[str]:
-        """Extract list of failed target labels."""
-        failed = []
-        for event in self.events:
             if 'aborted' in event or ('completed' in event and not event['completed'].get('success')):
                 if 'id' in event and 'targetCompleted' in event['id']:
                     label = event['id']['targetCompleted'].get('label')
                     if label:
-                        failed.append(label)
-        return failed
-
-    def get_slow_actions(self, threshold_ms: int = 1000) -> List[Dict]:
-        """Find actions that took longer than threshold."""
-        slow_actions = []
-        for event in self.events:
-            if 'action' in event:
-                action = event['action']
-                if 'actionMetrics' in action:
-                    metrics = action['actionMetrics']
-                    duration = metrics.get('executionTimeInMs', 0)
-                    if duration > threshold_ms:
-                        slow_actions.append({
-                            'mnemonic': action.get('type', 'Unknown'),
-                            'duration_ms': duration,
-                            'target': action.get('label', 'Unknown'),
-                        })
-        return sorted(slow_actions, key=lambda x: x['duration_ms'], reverse=True)
+                        add_failed(label)
+
+            action = event.get('action')
+            if action is not None and 'actionMetrics' in action:
+                duration = _as_number(action['actionMetrics'].get('executionTimeInMs', 0))
+                if duration is not None and duration > threshold_ms:
+                    slow = SlowAction(
+                        mnemonic=action.get('type', 'Unknown'),
+                        duration_ms=duration,
+                        target=action.get('label', 'Unknown'),
+                    )
+                    if top_n is None:
+                        add_slow(slow)
+                    elif top_n > 0:
+                        slow_seen += 1
+                        entry = (duration, -slow_seen, slow)
+                        if len(slow_heap) < top_n:
+                            heapq.heappush(slow_heap, entry)
+                        else:
+                            heapq.heappushpop(slow_heap, entry)
+
+        if top_n is None:
+            slow_actions.sort(key=attrgetter('duration_ms'), reverse=True)
+        else:
+            slow_actions = [slow for _, _, slow in sorted(slow_heap, reverse=True)]
+
+        return BEPAnalysis(
+            metrics=BuildMetrics(*acc),
+            failed_targets=failed_targets,
+            slow_actions=slow_actions,
+        )
+
+    def extract_metrics(self) -> BuildMetrics:
+        """Extract build metrics from BEP events.
+
+        Deprecated: use analyze().metrics, which also collects the other results.
+        """
+        _warn_single_result('extract_metrics', 'metrics')
+        return self.analyze().metrics
+
+    def get_failed_targets(self) -> List[str]:
+        """Extract list of failed target labels.
+
+        Deprecated: use analyze().failed_targets.
+        """
+        _warn_single_result('get_failed_targets', 'failed_targets')
+        return self.analyze().failed_targets
+
+    def get_slow_actions(self, threshold_ms: int = 1000,
+                         top_n: Optional[int] = None) -> List[SlowAction]:
+        """Find actions that took longer than threshold, optionally only the top_n.
+
+        Deprecated: use analyze(threshold_ms, top_n).slow_actions.
+        """
+        _warn_single_result('get_slow_actions', 'slow_actions')
+        return self.analyze(threshold_ms, top_n).slow_actions
+
+
+def get_reverse_graph() -> Dict[str, List[str]]:
+    """Return the reverse dependency graph of //..., building it at most once.
+
+    The graph maps each target to the targets that directly depend on it.
+    It is kept in-process and, for clean checkouts, persisted on disk keyed
+    by HEAD so later invocations skip the query entirely.
+    """
+    key = _workspace_key()
+    memo_key = key or _workspace_root()
+    if memo_key in _reverse_graph_cache:
+        return _reverse_graph_cache[memo_key]
+
+    graph = None
+    if key:
+        cached = _load_pickle(_RGRAPH_CACHE_FILE)
+        if cached is not None and cached[0] == key:
+            graph = cached[1]
+    if graph is None:
+        reverse = defaultdict(list)
+        # A broken package should cost its own edges, not the whole graph.
+        forward, complete = _query_graph("//...", keep_going=True)
+        for node, deps in forward.items():
+            for dep in deps:
+                reverse[dep].append(node)
+        graph = dict(reverse)
+        # A partial graph is not persisted, so a transient failure cannot
+        # hide tests for this commit in later runs.
+        if key and complete:
+            _save_pickle(_RGRAPH_CACHE_FILE, (key, graph))
+
+    _reverse_graph_cache[memo_key] = graph
+    return graph
+
+
+def _bounded_bfs(graph: Dict[str, List[str]], roots: Iterable[str],
+                 max_depth: Optional[int] = None) -> Dict[str, int]:
+    """Walk `graph` breadth-first from all roots at once.
+
+    Returns each reached node with its distance from the nearest root. Nodes
+    are visited once and nothing past `max_depth` is expanded, so the walk is
+    O(V+E) whatever depth is requested.
+    """
+    depths = {root: 0 for root in roots}
+    queue = deque(depths.items() if max_depth is None or max_depth > 0 else ())
+    while queue:
+        node, depth = queue.popleft()
+        for neighbour in graph.get(node, ()):
+            if neighbour not in depths:
+                depths[neighbour] = depth + 1
+                if max_depth is None or depth + 1 < max_depth:
+                    queue.append((neighbour, depth + 1))
+    return depths
+
+
+def _group_by_package(changed_files: Iterable[str]) -> Dict[str, List[str]]:
+    """Group changed files by their Bazel package, dropping paths outside any package."""
+    root = _workspace_root()
+    by_package = defaultdict(list)
+    for file_path in set(changed_files):
+        package = _find_package(root, os.path.dirname(file_path))
+        if package is not None:
+            by_package[package].append(file_path)
+    return by_package
 
 
 class DependencyAnalyzer:
     """Analyze dependency relationships between targets."""
 
     @staticmethod
-    def find_affected_targets(changed_files: List[str]) -> Set[str]:
-        """Find all targets affected by changed files."""
-        affected = set()
-
-        for file_path in changed_files:
-            # Find targets that include this file
-            try:
-                owners = BazelQuery.query(f'owner("{file_path}")')
-                affected.update(owners)
-
-                # Find reverse dependencies
-                for owner in owners:
-                    rdeps = BazelQuery.rdeps("//...", owner, depth=1)
-                    affected.update(rdeps)
-            except subprocess.CalledProcessError:
-                # File might not be tracked by Bazel
-                continue
+    def find_affected_targets(changed_files: List[str], depth: int = 1) -> Set[str]:
+        """Find all targets affected by changed files.
+
+        Changed files are grouped by package and turned into source file
+        labels, whose owners are their direct dependents in the cached
+        reverse dependency graph. One BFS over that graph then collects the
+        owners and their reverse dependencies up to `depth`, without a Bazel
+        query to resolve the owners.
+
+        A changed BUILD file affects every rule in its package; those rules
+        are fetched with one `//pkg:all` query and walked the same way.
+        """
+        file_labels = set()
+        build_packages = set()
+        for package, files in _group_by_package(changed_files).items():
+            prefix = len(package) + 1 if package else 0
+            for file_path in files:
+                if os.path.basename(file_path) in _BUILD_FILE_NAMES:
+                    build_packages.add(package)
+                else:
+                    file_labels.add(f"//{package}:{file_path[prefix:]}")
+        if not file_labels and not build_packages:
+            return set()
+
+        reverse_graph = get_reverse_graph()
+        # The files themselves sit at depth 0 and their owners at depth 1.
+        reached = _bounded_bfs(reverse_graph, file_labels, depth + 1)
+        affected = {target for target, level in reached.items() if level > 0}
+
+        if build_packages:
+            # BUILD files are not graph nodes, so their package's rules are
+            # queried directly and treated as owners.
+            expr = " + ".join(f"//{package}:all" for package in sorted(build_packages))
+            rules = BazelQuery.query_file(expr, keep_going=True)
+            affected.update(_bounded_bfs(reverse_graph, rules, depth))
 
         return affected
 
     @staticmethod
     def find_test_targets(targets: Set[str]) -> Set[str]:
-        """Filter test targets from a set of targets."""
-        tests = set()
-        for target in targets:
-            if '_test' in target or target.endswith('_tests'):
-                tests.add(target)
-        return tests
+        """Filter test targets from a set of targets.
 
-    @staticmethod
-    def analyze_dependencies(target: str) -> Dict[str, int]:
-        """Analyze dependency tree depth and breadth."""
-        all_deps = BazelQuery.deps(target, depth=100)
+        Uses Bazel's tests() operator, so test rules are recognised by kind
+        rather than by name.
+        """
+        if not targets:
+            return set()
+
+        expr = f'tests(//...) intersect set({" ".join(sorted(targets))})'
+        return set(BazelQuery.query_file(expr, keep_going=True))
 
+    @staticmethod
+    def analyze_dependencies(target: str) -> Dict[str, Union[int, List[str]]]:
+        """Analyze dependency tree depth and breadth.
+
+        The dependency graph is fetched once and walked locally; max_depth is
+        the BFS level of the farthest dependency, and direct_dependency_labels
+        lists the direct dependencies so callers need no further query.
+        """
+        graph = BazelQuery.deps_graph(target)
+
+        if target in graph:
+            roots = [target]
+        else:
+            # Patterns such as :all expand to several nodes; the roots are the
+            # nodes nothing else in the graph depends on.
+            dependents = {dep for deps in graph.values() for dep in deps}
+            roots = [node for node in graph if node not in dependents]
+
+        direct = sorted({dep for root in roots for dep in graph[root]})
         return {
-            'total_dependencies': len(all_deps),
-            'direct_dependencies': len(BazelQuery.deps(target, depth=1)) - 1,  # Exclude target itself
-            'max_depth': len(all_deps),  # Approximation
+            'total_dependencies': len(graph),
+            'direct_dependencies': len(direct),
+            'direct_dependency_labels': direct,
+            'max_depth': max(_bounded_bfs(graph, roots).values(), default=0),
         }
 
 
 def get_changed_files_from_git(base_branch: str = "main") -> List[str]:
-    """Get list of changed files from git diff."""
+    """Get list of changed files from git diff.
+
+    Deleted files are excluded since Bazel can no longer resolve their owners.
+    Paths are read NUL-delimited, so names containing newlines survive intact.
+    """
     result = subprocess.run(
-        ["git", "diff", "--name-only", f"{base_branch}...HEAD"],
+        ["git", "diff", "--name-only", "-z", "--diff-filter=ACMR", f"{base_branch}...HEAD"],
         capture_output=True,
-        text=True,
         check=True,
+        cwd=_workspace_root(),
     )
-    return [line.strip() for line in result.stdout.splitlines() if line.strip()]
+    return [path.decode('utf-8', 'surrogateescape') for path in result.stdout.split(b'\x00') if path]
@@ -0,0 +1,456 @@
+"""
+Tests for bazel_utils query caching, dependency analysis and BEP parsing.
+
+Usage:
+    bazel test //build_tools:bazel_utils_test
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import bazel_utils
+from bazel_utils import (
+    BEPAnalyzer,
+    DependencyAnalyzer,
+    SlowAction,
+    _bounded_bfs,
+    _cached_query,
+    _parse_dot_graph,
+    _prune_cache_dir,
+    _workspace_fingerprint,
+    _workspace_key,
+    get_changed_files_from_git,
+)
+
+# Output of `bazel query 'deps(//java/com/example/userservice:userservice)'
+# --output=graph --nograph:factored`, trimmed to a few nodes.
+DOT_OUTPUT = b'''digraph mygraph {
+  node [shape=box];
+  "//java/com/example/userservice:userservice"
+  "//java/com/example/userservice:userservice" -> "//java/com/example/userservice:service/UserService.java"
+  "//java/com/example/userservice:userservice" -> "//java/com/example/userservice:model/User.java"
+  "//java/com/example/userservice:userservice" -> "@maven//:com_google_guava_guava"
+  "@maven//:com_google_guava_guava"
+  "@maven//:com_google_guava_guava" -> "@maven//:v1/guava.jar"
+  "@maven//:v1/guava.jar"
+  "//java/com/example/userservice:model/User.java"
+  "//java/com/example/userservice:service/UserService.java"
+}
+'''
+
+
+class AnalyzeDependenciesTest(unittest.TestCase):
+
+    GRAPH = {
+        "//app:bin": ["//app:lib", "//app:main.ts"],
+        "//app:lib": ["//lib:core", "//app:lib.ts"],
+        "//app:lib_test": ["//app:lib"],
+        "//lib:core": ["//lib:core.ts"],
+        "//app:main.ts": [],
+        "//app:lib.ts": [],
+        "//lib:core.ts": [],
+    }
+
+    def analyze(self, target):
+        with mock.patch.object(bazel_utils.BazelQuery, "deps_graph",
+                               return_value=self.GRAPH) as deps_graph:
+            stats = DependencyAnalyzer.analyze_dependencies(target)
+        deps_graph.assert_called_once_with(target)
+        return stats
+
+    def test_single_target_uses_its_own_node_as_root(self):
+        stats = self.analyze("//app:lib")
+
+        self.assertEqual(stats['total_dependencies'], len(self.GRAPH))
+        self.assertEqual(stats['direct_dependency_labels'], ["//app:lib.ts", "//lib:core"])
+        self.assertEqual(stats['direct_dependencies'], 2)
+        self.assertEqual(stats['max_depth'], 2)
+
+    def test_pattern_roots_are_nodes_without_dependents(self):
+        # //app:all is not itself a node; //app:bin and //app:lib_test are
+        # the only nodes nothing depends on.
+        stats = self.analyze("//app:all")
+
+        self.assertEqual(stats['direct_dependency_labels'],
+                         ["//app:lib", "//app:main.ts"])
+        self.assertEqual(stats['max_depth'], 3)
+
+    def test_empty_graph(self):
+        with mock.patch.object(bazel_utils.BazelQuery, "deps_graph", return_value={}):
+            stats = DependencyAnalyzer.analyze_dependencies("//missing:all")
+
+        self.assertEqual(stats, {
+            'total_dependencies': 0,
+            'direct_dependencies': 0,
+            'direct_dependency_labels': [],
+            'max_depth': 0,
+        })
+
+
+class ParseDotGraphTest(unittest.TestCase):
+
+    def test_parses_edges_and_leaf_nodes(self):
+        graph = _parse_dot_graph(DOT_OUTPUT)
+
+        self.assertEqual(graph, {
+            "//java/com/example/userservice:userservice": [
+                "//java/com/example/userservice:service/UserService.java",
+                "//java/com/example/userservice:model/User.java",
+                "@maven//:com_google_guava_guava",
+            ],
+            "@maven//:com_google_guava_guava": ["@maven//:v1/guava.jar"],
+            "@maven//:v1/guava.jar": [],
+            "//java/com/example/userservice:model/User.java": [],
+            "//java/com/example/userservice:service/UserService.java": [],
+        })
+
+    def test_empty_graph(self):
+        self.assertEqual(_parse_dot_graph(b'digraph mygraph {\n  node [shape=box];\n}\n'), {})
+
+    def test_deps_graph_disables_the_node_limit(self):
+        with mock.patch.object(bazel_utils, "_run_query",
+                               return_value=(DOT_OUTPUT, True)) as run_query:
+            bazel_utils.BazelQuery.deps_graph("//java/com/example/userservice:userservice")
+
+        args = run_query.call_args.args[0]
+        self.assertIn("--nograph:factored", args)
+        self.assertIn("--graph:node_limit=-1", args)
+
+
+class BoundedBfsTest(unittest.TestCase):
+
+    GRAPH = {'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': ['e'], 'e': []}
+
+    def test_depth_limits(self):
+        self.assertEqual(_bounded_bfs(self.GRAPH, ['a'], 0), {'a': 0})
+        self.assertEqual(_bounded_bfs(self.GRAPH, ['a'], 1), {'a': 0, 'b': 1, 'c': 1})
+        self.assertEqual(_bounded_bfs(self.GRAPH, ['a'], 2), {'a': 0, 'b': 1, 'c': 1, 'd': 2})
+
+    def test_unbounded_reports_shortest_distance(self):
+        self.assertEqual(_bounded_bfs(self.GRAPH, ['a']),
+                         {'a': 0, 'b': 1, 'c': 1, 'd': 2, 'e': 3})
+
+    def test_multiple_roots(self):
+        self.assertEqual(_bounded_bfs(self.GRAPH, ['b', 'c'], 1),
+                         {'b': 0, 'c': 0, 'd': 1})
+
+
+class FindAffectedTargetsTest(unittest.TestCase):
+
+    # Forward graph as deps(//...) would return it.
+    FORWARD_GRAPH = {
+        "//:tsconfig": ["//:tsconfig.json"],
+        "//:tsconfig.json": [],
+        "//java/app:lib": ["//java/app:src/Lib.java",
+                           "//java/app:src/app.properties"],
+        "//java/app:lib_test": ["//java/app:lib", "//java/app:test/LibTest.java"],
+        "//java/app:all_tests": ["//java/app:lib_test"],
+        "//java/app:src/Lib.java": [],
+        "//java/app:src/app.properties": [],
+        "//java/app:test/LibTest.java": [],
+    }
+
+    def setUp(self):
+        workspace = tempfile.TemporaryDirectory()
+        self.addCleanup(workspace.cleanup)
+        root = Path(workspace.name)
+        (root / "BUILD.bazel").touch()
+        (root / "java" / "app" / "src").mkdir(parents=True)
+        (root / "java" / "app" / "BUILD.bazel").touch()
+
+        bazel_utils._reverse_graph_cache.clear()
+        bazel_utils._find_package.cache_clear()
+        for patcher in (
+            mock.patch.dict(os.environ, {"BUILD_WORKSPACE_DIRECTORY": workspace.name}),
+            mock.patch.object(bazel_utils, "_workspace_key", return_value=None),
+            mock.patch.object(bazel_utils, "_query_graph",
+                              return_value=(self.FORWARD_GRAPH, True)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_subdirectory_file_selects_owner_and_direct_rdeps(self):
+        affected = DependencyAnalyzer.find_affected_targets(["java/app/src/Lib.java"])
+
+        self.assertEqual(affected, {"//java/app:lib", "//java/app:lib_test"})
+
+    def test_depth_extends_reverse_walk(self):
+        affected = DependencyAnalyzer.find_affected_targets(["java/app/src/Lib.java"], depth=2)
+
+        self.assertEqual(affected, {"//java/app:lib", "//java/app:lib_test",
+                                    "//java/app:all_tests"})
+
+    def test_root_package_file(self):
+        self.assertEqual(DependencyAnalyzer.find_affected_targets(["tsconfig.json"]),
+                         {"//:tsconfig"})
+
+    def test_build_file_selects_package_rules(self):
+        with mock.patch.object(bazel_utils.BazelQuery, "query_file",
+                               return_value=["//java/app:lib"]) as query_file:
+            affected = DependencyAnalyzer.find_affected_targets(["java/app/BUILD.bazel"])
+
+        query_file.assert_called_once_with("//java/app:all", keep_going=True)
+        self.assertEqual(affected, {"//java/app:lib", "//java/app:lib_test"})
+
+    def test_source_files_need_no_query(self):
+        with mock.patch.object(bazel_utils.BazelQuery, "query_file") as query_file:
+            DependencyAnalyzer.find_affected_targets(["java/app/src/Lib.java"])
+
+        query_file.assert_not_called()
+
+    def test_duplicate_and_unowned_paths(self):
+        affected = DependencyAnalyzer.find_affected_targets(
+            ["README.md", "java/app/src/Lib.java", "java/app/src/Lib.java", "/elsewhere/X.java"])
+
+        self.assertEqual(affected, {"//java/app:lib", "//java/app:lib_test"})
+        self.assertEqual(DependencyAnalyzer.find_affected_targets(["README.md"]), set())
+
+    def test_any_extension_can_be_an_input(self):
+        affected = DependencyAnalyzer.find_affected_targets(["java/app/src/app.properties"])
+
+        self.assertEqual(affected, {"//java/app:lib", "//java/app:lib_test"})
+
+
+class FindTestTargetsTest(unittest.TestCase):
+
+    def test_intersects_tests_with_sorted_target_set(self):
+        with mock.patch.object(bazel_utils.BazelQuery, "query_file",
+                               return_value=["//app:lib_test"]) as query_file:
+            tests = DependencyAnalyzer.find_test_targets({"//app:lib_test", "//app:lib"})
+
+        query_file.assert_called_once_with(
+            "tests(//...) intersect set(//app:lib //app:lib_test)", keep_going=True)
+        self.assertEqual(tests, {"//app:lib_test"})
+
+    def test_empty_input_runs_no_query(self):
+        with mock.patch.object(bazel_utils.BazelQuery, "query_file") as query_file:
+            self.assertEqual(DependencyAnalyzer.find_test_targets(set()), set())
+
+        query_file.assert_not_called()
+
+
+class GetChangedFilesFromGitTest(unittest.TestCase):
+
+    def changed_files(self, stdout: bytes):
+        completed = subprocess.CompletedProcess([], 0, stdout=stdout, stderr=b'')
+        with mock.patch.object(bazel_utils.subprocess, "run", return_value=completed) as run:
+            files = get_changed_files_from_git("main")
+        self.assertIn("-z", run.call_args.args[0])
+        return files
+
+    def test_splits_on_nul_and_keeps_newlines_in_names(self):
+        self.assertEqual(self.changed_files(b'a/B.java\x00odd\nname.ts\x00'),
+                         ["a/B.java", "odd\nname.ts"])
+
+    def test_undecodable_bytes_round_trip(self):
+        files = self.changed_files(b'caf\xe9.txt\x00')
+
+        self.assertEqual(files, ["caf\udce9.txt"])
+        self.assertEqual(files[0].encode('utf-8', 'surrogateescape'), b'caf\xe9.txt')
+
+    def test_no_changes(self):
+        self.assertEqual(self.changed_files(b''), [])
+
+
+@unittest.skipUnless(shutil.which("git"), "git is not installed")
+class WorkspaceKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        workspace = tempfile.TemporaryDirectory()
+        self.addCleanup(workspace.cleanup)
+        self.root = Path(workspace.name)
+        (self.root / "java" / "app").mkdir(parents=True)
+        (self.root / "BUILD.bazel").touch()
+        (self.root / "MODULE.bazel").touch()
+        (self.root / "java" / "app" / "BUILD.bazel").touch()
+        for args in (["init", "-q"], ["add", "."],
+                     ["-c", "user.name=test", "-c", "user.email=test@example.com",
+                      "commit", "-q", "-m", "init"]):
+            subprocess.run(["git", *args], cwd=self.root, check=True, capture_output=True)
+
+        bazel_utils._find_package.cache_clear()
+        patcher = mock.patch.dict(os.environ, {"BUILD_WORKSPACE_DIRECTORY": workspace.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_clean_tree(self):
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=self.root, check=True,
+                              capture_output=True, text=True).stdout.strip()
+
+        self.assertEqual(_workspace_key(), f"{self.root}@{head}")
+
+    def test_bazel_generated_files_keep_the_key(self):
+        (self.root / "MODULE.bazel.lock").touch()
+        (self.root / "bazel-out").symlink_to(tempfile.gettempdir())
+
+        self.assertIsNotNone(_workspace_key())
+
+    def test_untracked_query_inputs_disable_the_key(self):
+        for path in ("java/app/New.java", "java/lib/BUILD"):
+            with self.subTest(path=path):
+                (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+                (self.root / path).touch()
+                self.addCleanup((self.root / path).unlink)
+
+                self.assertIsNone(_workspace_key())
+
+    def test_tracked_change_disables_the_key(self):
+        (self.root / "java" / "app" / "BUILD.bazel").write_text("# edited\n")
+
+        self.assertIsNone(_workspace_key())
+
+    def test_fingerprint_follows_module_mtime(self):
+        before = _workspace_fingerprint()
+        os.utime(self.root / "MODULE.bazel", ns=(0, 0))
+
+        self.assertNotEqual(_workspace_fingerprint(), before)
+        with mock.patch.object(bazel_utils, "_workspace_key", return_value=None):
+            self.assertIsNone(_workspace_fingerprint())
+
+
+class CachedQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = Path(cache_dir.name)
+        for patcher in (
+            mock.patch.object(bazel_utils, "_QUERY_CACHE_DIR", self.cache_dir),
+            mock.patch.object(bazel_utils, "_workspace_fingerprint", return_value="fp"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.complete = True
+        self.calls = []
+
+        def fake_query(expression, keep_going=False):
+            self.calls.append(expression)
+            return [f"//{expression}:target"], self.complete
+
+        self.query = _cached_query(fake_query)
+
+    def entries(self):
+        return sorted(path.name for path in self.cache_dir.glob("*.pickle"))
+
+    def test_miss_then_in_process_and_disk_hits(self):
+        self.assertEqual(self.query("a"), ["//a:target"])
+        self.assertEqual(self.query("a"), ["//a:target"])
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(len(self.entries()), 1)
+
+        self.query.cache_clear()
+        self.assertEqual(self.query("a"), ["//a:target"])
+        self.assertEqual(self.calls, ["a"])
+
+    def test_results_are_fresh_lists(self):
+        self.query("a").append("//mutated:target")
+
+        self.assertEqual(self.query("a"), ["//a:target"])
+
+    def test_partial_results_are_not_persisted(self):
+        self.complete = False
+        self.query("a", keep_going=True)
+        self.assertEqual(self.entries(), [])
+
+        self.query.cache_clear()
+        self.query("a", keep_going=True)
+        self.assertEqual(self.calls, ["a", "a"])
+
+    def test_no_fingerprint_skips_the_disk(self):
+        with mock.patch.object(bazel_utils, "_workspace_fingerprint", return_value=None):
+            self.query("a")
+
+        self.assertEqual(self.entries(), [])
+
+    def test_disk_cache_is_bounded(self):
+        with mock.patch.object(bazel_utils, "_QUERY_CACHE_MAX_ENTRIES", 2):
+            for expression in ("a", "b", "c"):
+                self.query(expression)
+
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_prune_evicts_least_recently_used(self):
+        for age, name in enumerate(("new", "mid", "old")):
+            path = self.cache_dir / f"{name}.pickle"
+            path.touch()
+            os.utime(path, ns=(0, (10 - age) * 10**9))
+        (self.cache_dir / "stray.tmp").touch()
+
+        _prune_cache_dir(self.cache_dir, 2)
+
+        self.assertEqual(self.entries(), ["mid.pickle", "new.pickle"])
+        self.assertTrue((self.cache_dir / "stray.tmp").exists())
+
+
+class BEPAnalyzerTest(unittest.TestCase):
+
+    def write_bep(self, content: str) -> Path:
+        f = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            f.write(content)
+        return Path(f.name)
+
+    def write_actions(self, durations) -> Path:
+        return self.write_bep("".join(
+            json.dumps({'action': {'type': 'Javac', 'label': f'//a:{i}',
+                                   'actionMetrics': {'executionTimeInMs': duration}}}) + "\n"
+            for i, duration in enumerate(durations)))
+
+    def test_empty_file(self):
+        analysis = BEPAnalyzer(self.write_bep("")).analyze()
+
+        self.assertEqual(analysis.metrics.total_targets, 0)
+        self.assertEqual(analysis.metrics.action_count, 0)
+        self.assertEqual(analysis.failed_targets, [])
+        self.assertEqual(analysis.slow_actions, [])
+
+    def test_last_line_without_newline(self):
+        bep = self.write_bep(
+            '{"id":{"targetConfigured":{"label":"//a:b"}},"configured":{}}\n'
+            '\n'
+            '{"id":{"targetCompleted":{"label":"//a:b"}},"completed":{"success":false}}')
+        analysis = BEPAnalyzer(bep).analyze()
+
+        self.assertEqual(analysis.metrics.total_targets, 1)
+        self.assertEqual(analysis.metrics.failed_targets, 1)
+        self.assertEqual(analysis.failed_targets, ["//a:b"])
+
+    def test_top_n_matches_full_sort(self):
+        analyzer = BEPAnalyzer(self.write_actions([1200, 4000, 1200, 2500, 1200, 4000, 10]))
+        full = analyzer.analyze(1000).slow_actions
+
+        for top_n in (0, 1, 2, 3, 4, 10):
+            with self.subTest(top_n=top_n):
+                self.assertEqual(analyzer.analyze(1000, top_n).slow_actions, full[:top_n])
+
+    def test_slow_actions_sorted_with_ties_in_file_order(self):
+        analysis = BEPAnalyzer(self.write_actions([1500, 5, 3000, 1500, 999.0, 1500.5])).analyze(1000)
+
+        self.assertEqual(analysis.slow_actions, [
+            SlowAction('Javac', 3000, '//a:2'),
+            SlowAction('Javac', 1500.5, '//a:5'),
+            SlowAction('Javac', 1500, '//a:0'),
+            SlowAction('Javac', 1500, '//a:3'),
+        ])
+
+    def test_string_durations_are_converted(self):
+        # proto3 JSON writes int64 fields as strings.
+        analysis = BEPAnalyzer(self.write_actions(["2000", 1500, "fast", "1200.5", None])).analyze(1000)
+
+        self.assertEqual(analysis.metrics.action_count, 5)
+        self.assertEqual(analysis.slow_actions, [
+            SlowAction('Javac', 2000, '//a:0'),
+            SlowAction('Javac', 1500, '//a:1'),
+            SlowAction('Javac', 1200.5, '//a:3'),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,13 +23,12 @@ def analyze_target_dependencies(target: str):
 
         print(f"\nTotal Dependencies:   {stats['total_dependencies']}")
         print(f"Direct Dependencies:  {stats['direct_dependencies']}")
+        print(f"Max Depth:            {stats['max_depth']}")
 
         # Show direct dependencies
         print("\nDirect Dependencies:")
-        direct_deps = BazelQuery.deps(target, depth=1)
-        for dep in sorted(direct_deps):
-            if dep != target:
-                print(f"  {dep}")
+        for dep in stats['direct_dependency_labels']:
+            print(f"  {dep}")
 
         # Find reverse dependencies
         print("\n" + "=" * 60)
@@ -13,10 +13,14 @@ Usage:
 """
 
 import argparse
+import os
 import sys
 from typing import List, Set
 from bazel_utils import DependencyAnalyzer, get_changed_files_from_git, BazelQuery
 
+# Files that change the module or workspace setup rather than any one package.
+_WORKSPACE_FILE_NAMES = ("MODULE.bazel", "WORKSPACE", "WORKSPACE.bazel")
+
 
 def select_tests(changed_files: List[str]) -> Set[str]:
     """
@@ -93,6 +97,15 @@ def main():
         if len(changed_files) > 10:
             print(f"  ... and {len(changed_files) - 10} more")
 
+        unmapped = [
+            f for f in changed_files
+            if f.endswith('.bzl') or os.path.basename(f) in _WORKSPACE_FILE_NAMES
+        ]
+        if unmapped:
+            print(f"\nNote: {len(unmapped)} changed .bzl, MODULE.bazel or WORKSPACE "
+                  "file(s) are not mapped to targets; run the full test suite to "
+                  "cover them")
+
         # Select tests
         test_targets = select_tests(changed_files)
 